@@ -1,5 +1,26 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# Cap BLAS threading before NumPy (or anything that drags it in) loads:
+# each worker gets its share of the cores so concurrent requests don't
+# oversubscribe the machine with competing OpenBLAS/MKL pools. Set
+# WEB_CONCURRENCY to the gunicorn -w count.
+_BLAS_THREADS = str(max(1, (os.cpu_count() or 1)
+                        // int(os.environ.get('WEB_CONCURRENCY', '1'))))
+os.environ.setdefault('OPENBLAS_NUM_THREADS', _BLAS_THREADS)
+os.environ.setdefault('MKL_NUM_THREADS', _BLAS_THREADS)
+print(f"BLAS threads per worker: {os.environ['OPENBLAS_NUM_THREADS']}")
+
 from flask import Flask, request, jsonify
+from flask_caching import Cache
 from flask_cors import CORS
+from numba import njit, prange
+import orjson
+import requests
 import yfinance as yf
 import pandas as pd
 import numpy as np
@@ -7,7 +28,258 @@ import numpy as np
 app = Flask(__name__)
 CORS(app)  # Allow requests from Next.js frontend
 
+TRADING_DAYS = 252
+SQRT_252 = float(np.sqrt(TRADING_DAYS))
+
+# Cache whole responses keyed on the request body so identical analyses
+# don't even re-enter the handler
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache',
+                           'CACHE_DEFAULT_TIMEOUT': 900})
+
+# Cache downloaded price frames so repeated requests for the same ticker set
+# don't hit Yahoo again within the TTL (these are daily bars, so 15 minutes
+# of staleness is fine). Lock because the dev server is multi-threaded.
+PRICE_CACHE_TTL = 900  # seconds
+_PRICE_CACHE = {}
+_PRICE_CACHE_LOCK = threading.Lock()
+
+
+# Yahoo's spark endpoint returns daily closes for up to 20 symbols in one
+# HTTP request, skipping yfinance's per-symbol overhead. The session keeps
+# the connection alive across requests.
+SPARK_URL = 'https://query1.finance.yahoo.com/v8/finance/spark'
+SPARK_MAX_SYMBOLS = 20
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.headers['User-Agent'] = 'Mozilla/5.0'
+
+
+def _fetch_spark(symbols, period):
+    """Fetch daily closes for all symbols in one spark call, None on failure"""
+    resp = _HTTP_SESSION.get(SPARK_URL, params={
+        'symbols': ','.join(symbols),
+        'range': period,
+        'interval': '1d',
+        'indicators': 'close',
+    }, timeout=10)
+    if resp.status_code != 200:
+        return None
+    payload = orjson.loads(resp.content)
+    closes = {}
+    for sym in symbols:
+        node = payload.get(sym)
+        if node is None or not node.get('close'):
+            return None
+        # Spark stamps daily bars with the market-open time; normalize to
+        # midnight so these rows line up with yfinance-sourced series
+        # instead of outer-joining onto disjoint intraday indexes
+        index = pd.to_datetime(np.asarray(node['timestamp'], dtype=np.int64),
+                               unit='s').normalize()
+        closes[sym] = pd.Series(np.asarray(node['close'], dtype=np.float32),
+                                index=index)
+    # Outer join on timestamps; same ('Close', symbol) column layout as
+    # yf.download(group_by='column') so the handler doesn't care which
+    # path produced the frame
+    data = pd.concat(closes, axis=1)
+    data.columns = pd.MultiIndex.from_product([['Close'], data.columns])
+    return data
+
+
+# Per-ticker close series cached on disk keyed by (symbol, date, period),
+# so overlapping portfolios share columns and a request only downloads the
+# tickers it hasn't seen today. Keys are MD5-hashed so symbols like ^GSPC
+# never run into filesystem naming rules.
+DISK_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '.cache')
+os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+
+
+def _disk_cache_path(symbol, day, period):
+    key = hashlib.md5(f'{symbol}:{day}:{period}'.encode()).hexdigest()
+    return os.path.join(DISK_CACHE_DIR, key + '.pkl')
+
+
+def _disk_cache_get(symbol, day, period):
+    path = _disk_cache_path(symbol, day, period)
+    if os.path.exists(path):
+        try:
+            return pd.read_pickle(path)
+        except Exception:
+            pass
+    return None
+
+
+def _disk_cache_put(symbol, day, period, series):
+    try:
+        series.to_pickle(_disk_cache_path(symbol, day, period))
+    except Exception as e:
+        print(f"Disk cache write failed for {symbol}: {e}")
+
+
+def _fetch_batch(symbols, period):
+    """One batched download for the given symbols (spark, then yfinance)"""
+    data = None
+    if len(symbols) <= SPARK_MAX_SYMBOLS:
+        try:
+            data = _fetch_spark(symbols, period)
+        except Exception as e:
+            print(f"Spark fetch failed ({e}), falling back to yfinance")
+    if data is None:
+        # auto_adjust=False so the fallback returns raw closes like spark
+        # does — a symbol must never flip between adjusted and unadjusted
+        # prices depending on which path (and which cached day) produced it
+        data = yf.download(list(symbols), period=period, progress=False,
+                           group_by='column', auto_adjust=False, threads=True)
+    return data
+
+
+def fetch_prices(symbols, period='1y'):
+    """Assemble close prices, reusing memory- and disk-cached series"""
+    key = (tuple(sorted(symbols)), period)
+    with _PRICE_CACHE_LOCK:
+        cached = _PRICE_CACHE.get(key)
+        if cached is not None and time.time() - cached[0] < PRICE_CACHE_TTL:
+            print(f"Cache hit for: {sorted(symbols)}")
+            return cached[1]
+
+    today = date.today().isoformat()
+    closes = {}
+    for sym in symbols:
+        series = _disk_cache_get(sym, today, period)
+        if series is not None:
+            closes[sym] = series
+
+    # One batched download covers whatever today's disk cache is missing
+    missing = [s for s in symbols if s not in closes]
+    if missing:
+        fetched = _fetch_batch(missing, period)['Close']
+        if isinstance(fetched, pd.Series):
+            fetched = fetched.to_frame(missing[0])
+        for sym in missing:
+            closes[sym] = fetched[sym]
+            _disk_cache_put(sym, today, period, fetched[sym])
+
+    # Trim the outer join to rows where every requested symbol has a bar:
+    # disk-cached series can end earlier than a freshly fetched column
+    # (e.g. cached pre-open, refetched after today's bar exists), and
+    # ragged trailing NaNs would otherwise flow into the handler's
+    # current-price and moving-average reads
+    data = pd.concat(closes, axis=1)[list(symbols)].dropna()
+    data.columns = pd.MultiIndex.from_product([['Close'], data.columns])
+    with _PRICE_CACHE_LOCK:
+        _PRICE_CACHE[key] = (time.time(), data)
+    return data
+
+
+# Background pool so the frontend can kick off downloads while the user is
+# still assembling a portfolio; /api/analyze then finds the data already in
+# flight (or cached) instead of paying the round-trip itself
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=8)
+_PREFETCH_FUTURES = {}
+_PREFETCH_LOCK = threading.Lock()
+
+
+@njit(cache=True, fastmath=True)
+def max_dd(log_returns):
+    """Maximum drawdown of a daily log-return series in one pass
+
+    Log returns are additive, so the scan keeps a running sum and peak and
+    only exponentiates the single worst gap at the end.
+    """
+    cum = 0.0
+    peak = 0.0
+    worst = 0.0
+    for i in range(log_returns.size):
+        cum += log_returns[i]
+        if cum > peak:
+            peak = cum
+        dd = cum - peak
+        if dd < worst:
+            worst = dd
+    return np.exp(worst) - 1.0
+
+
+@njit(parallel=True, fastmath=True, cache=True, error_model='numpy')
+def compute_metrics(rets, prices, Z, vol_out, beta_out, ma50_out, port_rets):
+    """
+    One fused parallel pass over the returns matrix.
+
+    error_model='numpy' keeps degenerate input — a constant-price column or
+    fewer than two usable rows — producing NaN stats like the pandas code
+    did, instead of raising ZeroDivisionError.
+
+    rets is (T, N+1) daily log returns with ^GSPC in the last column; prices is
+    the (rows, N) close matrix for the stocks only. Writes the normalized
+    returns Z (for the correlation GEMM), annualized volatility, per-stock
+    beta, 50-day moving average and equal-weighted portfolio returns into
+    the preallocated output buffers.
+    """
+    T = rets.shape[0]
+    N = rets.shape[1] - 1
+
+    # Index column moments first — every beta shares them
+    m_mean = 0.0
+    for i in range(T):
+        m_mean += rets[i, N]
+    m_mean /= T
+    m_var = 0.0
+    for i in range(T):
+        d = rets[i, N] - m_mean
+        m_var += d * d
+    m_sd = np.sqrt(m_var / (T - 1))
+    m_var /= T
+    for i in range(T):
+        Z[i, N] = (rets[i, N] - m_mean) / m_sd
+
+    rows = prices.shape[0]
+    window = 50 if rows >= 50 else rows
+
+    for j in prange(N):
+        mean_j = 0.0
+        for i in range(T):
+            mean_j += rets[i, j]
+        mean_j /= T
+        var_j = 0.0
+        cov_j = 0.0
+        for i in range(T):
+            d = rets[i, j] - mean_j
+            var_j += d * d
+            cov_j += d * (rets[i, N] - m_mean)
+        sd_j = np.sqrt(var_j / (T - 1))
+        for i in range(T):
+            Z[i, j] = (rets[i, j] - mean_j) / sd_j
+        vol_out[j] = sd_j * SQRT_252
+        beta_out[j] = (cov_j / T) / m_var
+        acc = 0.0
+        for i in range(rows - window, rows):
+            acc += prices[i, j]
+        ma50_out[j] = acc / window
+
+    # Equal-weighted portfolio return per day
+    for i in range(T):
+        acc = 0.0
+        for j in range(N):
+            acc += rets[i, j]
+        port_rets[i] = acc / N
+
+
+# Warm the lazy initializers at import time so the first request doesn't pay
+# for the Numba JIT compile or the BLAS thread-pool spin-up. The warm-up
+# data is non-degenerate (non-constant columns) so every division in the
+# kernel sees real values.
+max_dd(np.zeros(1, dtype=np.float32))
+compute_metrics(np.arange(1, 7, dtype=np.float32).reshape(3, 2) / 10.0,
+                np.arange(1, 4, dtype=np.float64).reshape(3, 1),
+                np.empty((3, 2), dtype=np.float32),
+                np.empty(1, dtype=np.float32),
+                np.empty(1, dtype=np.float32),
+                np.empty(1, dtype=np.float32),
+                np.empty(3, dtype=np.float32))
+_ = np.ones((8, 8), dtype=np.float32) @ np.ones((8, 8), dtype=np.float32)
+
 @app.route('/api/analyze', methods=['POST'])
+@cache.cached(timeout=900,
+              key_prefix=lambda: hashlib.md5(request.get_data()).hexdigest(),
+              response_filter=lambda rv: rv[1] == 200)
 def analyze_portfolio():
     """
     Receives a list of stock tickers and returns correlation matrix
@@ -19,36 +291,27 @@ def analyze_portfolio():
         if not tickers:
             return jsonify({'error': 'No tickers provided'}), 400
         
-        # Download 1 year of historical data
+        # Download 1 year of historical data for the portfolio and the S&P 500
+        # in one batched call (yfinance fetches the symbols on its own thread
+        # pool, so this costs one round-trip instead of two). If a prefetch is
+        # already in flight for this ticker set, just wait on it.
         print(f"Fetching data for: {tickers}")
-        raw_data = yf.download(tickers, period='1y', progress=False)
-        
-        # Debug: print data structure
-        print(f"Data columns: {raw_data.columns}")
-        print(f"Is MultiIndex: {isinstance(raw_data.columns, pd.MultiIndex)}")
-        
-        # Handle different yfinance response formats
-        stock_data = None
-        
-        if isinstance(raw_data.columns, pd.MultiIndex):
-            # Multiple tickers - try Close first, then Adj Close
-            if 'Close' in raw_data.columns.get_level_values(0):
-                stock_data = raw_data['Close']
-                print("Using 'Close' from MultiIndex")
-            elif 'Adj Close' in raw_data.columns.get_level_values(0):
-                stock_data = raw_data['Adj Close']
-                print("Using 'Adj Close' from MultiIndex")
-        else:
-            # Single level columns - try Close first, then Adj Close
-            if 'Close' in raw_data.columns:
-                stock_data = raw_data[['Close']].rename(columns={'Close': tickers[0]}) if len(tickers) == 1 else raw_data['Close']
-                print("Using 'Close' from single level")
-            elif 'Adj Close' in raw_data.columns:
-                stock_data = raw_data[['Adj Close']].rename(columns={'Adj Close': tickers[0]}) if len(tickers) == 1 else raw_data['Adj Close']
-                print("Using 'Adj Close' from single level")
-        
-        if stock_data is None or stock_data.empty:
+        symbols = tickers + ['^GSPC']
+        with _PREFETCH_LOCK:
+            future = _PREFETCH_FUTURES.pop(tuple(sorted(symbols)), None)
+        raw_data = future.result() if future is not None else fetch_prices(symbols)
+
+        # Both fetch paths return ('Close', symbol) MultiIndex columns —
+        # spark builds that shape directly and yf.download is pinned to it
+        # via group_by='column' — so extraction is a single unconditional
+        # lookup instead of a format-sniffing branch ladder
+        stock_data = raw_data['Close']
+
+        if stock_data.empty:
             return jsonify({'error': 'Could not extract price data from yfinance response', 'columns': str(raw_data.columns)}), 500
+
+        # Split the S&P 500 back out so stock_data holds only the user tickers
+        sp500_prices = stock_data.pop('^GSPC')
         
         # Handle single ticker (returns Series instead of DataFrame)
         if len(tickers) == 1:
@@ -57,90 +320,117 @@ def analyze_portfolio():
                 'tickers': tickers
             }), 400
         
-        # Calculate correlation matrix
-        correlation_matrix = stock_data.corr()
-        
-        # Calculate additional metrics
-        returns = stock_data.pct_change()
-        
-        # Annualized volatility (individual stocks)
-        volatility = returns.std() * np.sqrt(252)
-        
-        # 50-day moving average (most recent value)
-        ma_50 = stock_data.rolling(window=50).mean().iloc[-1]
-        
+        # Daily prices for stocks + S&P 500 as one float32 matrix (^GSPC is
+        # the last column); a boolean mask drops days where any symbol is
+        # missing a bar, with no intermediate aligned DataFrame. FP32 halves
+        # the cache footprint of every reduction below and its ~7 significant
+        # digits are far beyond the 3-4 decimals we round to.
+        arr = np.column_stack([stock_data.to_numpy(dtype=np.float32),
+                               sp500_prices.to_numpy(dtype=np.float32)])
+        arr = arr[~np.isnan(arr).any(axis=1)]
+
+        # One log-return matrix drives every metric: log returns are
+        # additive, which turns the drawdown scan into a running sum, and
+        # they differ from simple daily returns by well under a basis point
+        rets = arr[1:] / arr[:-1]
+        np.log(rets, out=rets)
+
+        # One fused Numba pass produces the normalized matrix plus every
+        # per-stock stat; the correlation matrix is then a single BLAS
+        # matrix multiply on the kernel's Z output
+        num_days, num_cols = rets.shape
+        num_stocks = num_cols - 1
+        price_arr = stock_data.to_numpy()
+        Z = np.empty_like(rets)
+        volatility = np.empty(num_stocks, dtype=np.float32)
+        betas = np.empty(num_stocks, dtype=np.float32)
+        ma_50 = np.empty(num_stocks, dtype=np.float32)
+        portfolio_returns = np.empty(num_days, dtype=np.float32)
+        compute_metrics(rets, price_arr, Z, volatility, betas, ma_50,
+                        portfolio_returns)
+        corr = (Z.T @ Z) / (num_days - 1)
+
+        current_prices = price_arr[-1]
+
         # PORTFOLIO METRICS (Equal Weighted)
-        # Calculate equal-weighted portfolio returns
-        portfolio_returns = returns.mean(axis=1)  # Equal weight = average across stocks
-        
-        # Fetch S&P 500 data for beta calculation
-        sp500_raw = yf.download('^GSPC', period='1y', progress=False)
-        
-        # Extract S&P 500 prices
-        if isinstance(sp500_raw.columns, pd.MultiIndex):
-            if 'Close' in sp500_raw.columns.get_level_values(0):
-                sp500_prices = sp500_raw['Close'].squeeze()
-            elif 'Adj Close' in sp500_raw.columns.get_level_values(0):
-                sp500_prices = sp500_raw['Adj Close'].squeeze()
-        else:
-            if 'Close' in sp500_raw.columns:
-                sp500_prices = sp500_raw['Close']
-            elif 'Adj Close' in sp500_raw.columns:
-                sp500_prices = sp500_raw['Adj Close']
-            else:
-                sp500_prices = sp500_raw.iloc[:, 0]  # First column
-        
-        sp500_returns = sp500_prices.pct_change()
-        
-        # Align dates between portfolio and S&P 500
-        aligned_data = pd.DataFrame({
-            'portfolio': portfolio_returns,
-            'sp500': sp500_returns
-        }).dropna()
-        
         # Portfolio Sharpe Ratio (assuming 0% risk-free rate)
-        portfolio_return = aligned_data['portfolio'].mean() * 252  # Annualized
-        portfolio_volatility = aligned_data['portfolio'].std() * np.sqrt(252)
+        portfolio_return = portfolio_returns.mean() * TRADING_DAYS  # Annualized
+        portfolio_volatility = portfolio_returns.std(ddof=1) * SQRT_252
         sharpe_ratio = portfolio_return / portfolio_volatility if portfolio_volatility != 0 else 0
+
+        # Portfolio Beta (relative to S&P 500): equal weights make it the
+        # mean of the per-stock betas from the kernel
+        beta = betas.mean()
+
+        # Maximum Drawdown (single fused pass, no intermediate arrays)
+        max_drawdown = max_dd(portfolio_returns)
         
-        # Portfolio Beta (relative to S&P 500)
-        covariance = aligned_data['portfolio'].cov(aligned_data['sp500'])
-        sp500_variance = aligned_data['sp500'].var()
-        beta = covariance / sp500_variance if sp500_variance != 0 else 0
-        
-        # Maximum Drawdown
-        cumulative_returns = (1 + aligned_data['portfolio']).cumprod()
-        running_max = cumulative_returns.cummax()
-        drawdown = (cumulative_returns - running_max) / running_max
-        max_drawdown = drawdown.min()
-        
-        # Prepare response
+        # Prepare response straight from the NumPy arrays — no pandas
+        # round()/to_dict() object machinery in between. The correlation
+        # matrix is symmetric with a unit diagonal, so only the upper
+        # triangle is sent; the frontend mirrors it back into a full matrix.
+        # Widen float32 results to float64 before rounding — rounding in
+        # float32 and serializing emits the full repr of the nearest float32
+        # (e.g. -0.02800000086426735), tripling the payload for nothing
+        cols = list(stock_data.columns)
+        iu = np.triu_indices(num_stocks, k=1)
         response = {
-            'correlation': correlation_matrix.round(3).to_dict(),
-            'volatility': volatility.round(4).to_dict(),
-            'current_prices': stock_data.iloc[-1].round(2).to_dict(),
-            'ma_50': ma_50.round(2).to_dict(),
+            'correlation_upper': {
+                'i': iu[0].tolist(),
+                'j': iu[1].tolist(),
+                'r': np.round(corr[:-1, :-1][iu].astype(np.float64), 3).tolist(),
+                'cols': cols,
+            },
+            'volatility': dict(zip(cols, volatility.astype(np.float64).round(4).tolist())),
+            'current_prices': dict(zip(cols, current_prices.astype(np.float64).round(2).tolist())),
+            'ma_50': dict(zip(cols, ma_50.astype(np.float64).round(2).tolist())),
             'portfolio_metrics': {
-                'sharpe_ratio': round(sharpe_ratio, 3),
-                'beta': round(beta, 3),
-                'max_drawdown': round(max_drawdown, 4),
-                'annualized_return': round(portfolio_return, 4),
-                'annualized_volatility': round(portfolio_volatility, 4)
+                'sharpe_ratio': round(float(sharpe_ratio), 3),
+                'beta': round(float(beta), 3),
+                'max_drawdown': round(float(max_drawdown), 4),
+                'annualized_return': round(float(portfolio_return), 4),
+                'annualized_volatility': round(float(portfolio_volatility), 4)
             },
             'tickers': tickers
         }
-        
-        return jsonify(response), 200
+
+        return app.response_class(
+            orjson.dumps(response, option=orjson.OPT_SERIALIZE_NUMPY),
+            mimetype='application/json'), 200
         
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/prefetch', methods=['POST'])
+def prefetch_portfolio():
+    """
+    Kicks off a background download for a ticker set so a following
+    /api/analyze call finds the data already cached
+    """
+    data = request.get_json()
+    tickers = data.get('tickers', [])
+
+    if not tickers:
+        return jsonify({'error': 'No tickers provided'}), 400
+
+    symbols = tickers + ['^GSPC']
+    key = tuple(sorted(symbols))
+    with _PREFETCH_LOCK:
+        if key not in _PREFETCH_FUTURES:
+            _PREFETCH_FUTURES[key] = _PREFETCH_POOL.submit(fetch_prices, symbols)
+
+    return jsonify({'status': 'prefetching', 'tickers': tickers}), 202
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint"""
     return jsonify({'status': 'healthy', 'message': 'Portfolio Analyzer API is running'}), 200
 
 if __name__ == '__main__':
-    print("Starting Flask server on http://localhost:5001")
+    # Local development only — in production run under a real WSGI server so
+    # concurrent requests overlap their yfinance I/O instead of queuing:
+    #   gunicorn -w 4 --threads 8 -k gthread backend.app:app
+    print("Starting Flask dev server on http://localhost:5001")
     app.run(debug=True, port=5001, host='127.0.0.1')
\ No newline at end of file
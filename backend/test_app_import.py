@@ -0,0 +1,14 @@
+"""
+Smoke test: importing the app must not raise
+The Numba kernels are compiled and warmed at import time, so a bad warm-up
+breaks startup entirely — this catches that before deploy
+"""
+
+
+def test_app_imports():
+    import app  # noqa: F401
+
+
+if __name__ == "__main__":
+    test_app_imports()
+    print("app imported OK")